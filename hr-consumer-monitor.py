@@ -7,30 +7,45 @@ Date: 6.10.2024
 
 File Description & Approach:
 This Python script monitors heart rate data by reading messages from a RabbitMQ queue 
-and using a deque to track the most recent readings. It checks for significant changes 
+and using deques to track the most recent readings. It checks for significant changes 
 in heart rate (drops, stalls, or elevations) within specific time windows, and sends 
-an email alert using SMTP if any condition is met. The script establishes a RabbitMQ 
-connection, manages the queue, processes messages with a callback function, and includes 
+an email alert using SMTP if any condition is met. All three checks run in a single 
+callback, so this one consumer replaces the separate drop, stall, and elevated consumers 
+and only needs one RabbitMQ connection and one set of email settings. The queue and its 
+messages are intentionally non-durable: a stale heart rate reading adds no value to an alert, 
+so readings are kept in broker memory rather than persisted to disk. The script establishes a 
+RabbitMQ connection, manages the queue, processes messages with a callback function, and includes 
 robust error handling. It is designed for both direct execution and module importation, 
 requiring Python 3.11 for TOML support.
 
 """
+import atexit
 from collections import deque
-from email.message import EmailMessage
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
 import pika
-import pprint
 import smtplib
+import struct
 import sys
+import time
 import tomllib  # requires Python 3.11
 
+# Module logger
+logger = logging.getLogger(__name__)
+
 # Declare variables
 heart_rate_monitor_queue = "01-heart-rate-monitor"
-heart_rate_drop_queue = "02-heart-rate-drop"
-heart_rate_stall_queue = "03-heart-rate-stall"
-heart_rate_elevated_queue = "04-heart-rate-elevated"
-drop_deque = deque(maxlen=5)  # limited to 5 items (the 5 most recent readings)
-stall_deque = deque(maxlen=20)  # limited to 20 items (the 20 most recent readings)
-elevated_deque = deque(maxlen=4)  # limited to 4 items (the 4 most recent readings)
+heart_rate_exchange = "hr-fanout"  # fanout exchange the producer publishes each reading to
+heart_rate_struct = struct.Struct("<dd")  # 16-byte message: unix time stamp, heart rate (both float64)
+drop_window = 5  # the 5 most recent readings
+elevated_window = 4  # the 4 most recent readings
+stall_window = 20  # the 20 most recent readings
+# One shared buffer of recent readings, long enough for the drop and elevated windows
+reading_deque = deque(maxlen=max(drop_window, elevated_window))
+stall_max_deque = deque()  # (heart rate, index) pairs in decreasing order; the front is the window max
+stall_min_deque = deque()  # (heart rate, index) pairs in increasing order; the front is the window min
+stall_index = 0  # number of readings added to the stall window so far
 
 # Email subjects and contents
 drop_subject = "HEART RATE DROP ALERT"
@@ -42,107 +57,301 @@ stall_content = "HEART RATE STALL ALERT: Heart rate change is less than 1 bpm in
 elevated_subject = "HEART RATE ELEVATED ALERT"
 elevated_content = "HEART RATE ELEVATED ALERT: Heart rate has increased by 20 bpm or more in the last 2 minutes."
 
-def create_and_send_email_alert(email_subject: str, email_body: str):
-    """Read outgoing email info from a TOML config file"""
+# Alert rate limiting (at most one email per alert type every 5 minutes)
+alert_cooldown = 300  # seconds; longer than the 2.5, 10, and 2 minute analysis windows
+last_alert_times = {}  # alert type -> time.monotonic() of the last email sent
+
+# Acknowledgement batching (kept well under the prefetch count of 64)
+ack_batch_size = 16  # acknowledge every 16 messages with a single multiple=True ack
+ack_flush_interval = 1.0  # seconds between flushes of a partial batch
+unacked_count = 0
+last_delivery_tag = None
+
+# Consumer connection state
+consumer_channel = None  # the channel messages are consumed on, once it is open
+closing_connection = False  # True once the user has asked to stop listening
+close_reason = None  # why the connection or channel closed, when the user did not ask it to
+
+# Read outgoing email info from a TOML config file once, at startup
+with open(".env.toml", "rb") as file_object:
+    email_settings = tomllib.load(file_object)
 
-    with open(".env.toml", "rb") as file_object:
-        secret_dict = tomllib.load(file_object)
-    pprint.pprint(secret_dict)
+# SMTP session (opened on the first alert, then reused)
+smtp_server = None
+smtp_timeout = 10  # seconds before a blocked SMTP connect, NOOP, or send gives up
+
+# A single worker sends alerts in order without blocking message consumption;
+# only this worker thread touches the SMTP session, and queued alerts are sent before exit
+email_executor = ThreadPoolExecutor(max_workers=1)
+
+def connect_smtp_server():
+    """Open a new SMTP session, log in, and cache it for later alerts."""
+    global smtp_server
 
     # Basic information
-    host = secret_dict["outgoing_email_host"]
-    port = secret_dict["outgoing_email_port"]
-    outemail = secret_dict["outgoing_email_address"]
-    outpwd = secret_dict["outgoing_email_password"]
-
-    # Create an instance of an EmailMessage
-    msg = EmailMessage()
-    msg["From"] = outemail
-    msg["To"] = outemail
-    msg["Reply-to"] = outemail
-    msg["Subject"] = email_subject
-    msg.set_content(email_body)
-
-    print("========================================")
-    print(f"Prepared Email Message: ")
-    print("========================================")
-    print()
-    print(f"{str(msg)}")
-    print("========================================")
-    print()
+    host = email_settings["outgoing_email_host"]
+    port = email_settings["outgoing_email_port"]
+    outemail = email_settings["outgoing_email_address"]
+    outpwd = email_settings["outgoing_email_password"]
 
-    try:
-        if port == 465:
-            # Use SMTP_SSL for port 465
-            server = smtplib.SMTP_SSL(host, port)
-        else:
-            # Use SMTP for port 587
-            server = smtplib.SMTP(host, port)
-            server.starttls()
+    if port == 465:
+        # Use SMTP_SSL for port 465
+        server = smtplib.SMTP_SSL(host, port, timeout=smtp_timeout)
+    else:
+        # Use SMTP for port 587
+        server = smtplib.SMTP(host, port, timeout=smtp_timeout)
+        server.starttls()
 
+    # Debug output flushes between SMTP commands, so only enable it when asked for
+    if os.environ.get("SMTP_DEBUG"):
         server.set_debuglevel(2)
 
-        print("========================================")
-        print(f"SMTP server created: {str(server)}")
-        print("========================================")
-        print()
+    server.login(outemail, outpwd)
+    smtp_server = server
+    return server
 
-        server.login(outemail, outpwd)
-        print("========================================")
-        print(f"Successfully logged in as {outemail}.")
-        print("========================================")
-        print()
+def get_smtp_server():
+    """Return the cached SMTP session, reconnecting if it is missing or no longer healthy."""
+    if smtp_server is None:
+        return connect_smtp_server()
 
-        server.send_message(msg)
-        print("========================================")
-        print(f"Message sent.")
-        print("========================================")
-        print()
+    # Use NOOP as a cheap health check before reusing the session
+    try:
+        code, _ = smtp_server.noop()
+    except OSError:
+        code = None
+    if code != 250:
+        # Close the old socket before replacing the session so it is not leaked
+        smtp_server.close()
+        return connect_smtp_server()
+    return smtp_server
+
+def close_smtp_server():
+    """Terminate the cached SMTP session, if one is open."""
+    global smtp_server
+
+    if smtp_server is None:
+        return
+    try:
+        smtp_server.quit()
+    except OSError:
+        pass
+    smtp_server = None
+
+# Close the SMTP session once, when the program exits
+atexit.register(close_smtp_server)
+
+def build_alert_message(email_subject: str, email_body: str) -> bytes:
+    """Build the raw RFC 5322 bytes of a plain-text email to the outgoing address."""
+    outemail = email_settings["outgoing_email_address"]
+    return (
+        f"From: {outemail}\r\n"
+        f"To: {outemail}\r\n"
+        f"Reply-To: {outemail}\r\n"
+        f"Subject: {email_subject}\r\n"
+        f"\r\n"
+        f"{email_body}\r\n"
+    ).encode()
+
+# The alert emails never change, so build them once at startup
+drop_message = build_alert_message(drop_subject, drop_content)
+stall_message = build_alert_message(stall_subject, stall_content)
+elevated_message = build_alert_message(elevated_subject, elevated_content)
+
+def create_and_send_email_alert(alert_type: str, email_message: bytes):
+    """Send a prebuilt email alert over the cached SMTP session."""
+    outemail = email_settings["outgoing_email_address"]
+
+    try:
+        server = get_smtp_server()
+        server.sendmail(outemail, [outemail], email_message)
     except Exception as e:
-        print(f"Failed to connect or send email: {e}")
-    finally:
-        server.quit()
-        print("========================================")
-        print(f"Session terminated.")
-        print("========================================")
+        logger.error("Failed to connect or send email: %s", e)
+        # Clear the cooldown so the next reading in alert state retries instead of waiting 5 minutes
+        last_alert_times.pop(alert_type, None)
+
+def send_alert(alert_type: str, email_message: bytes):
+    """Queue an email alert unless the same alert type was already sent within the cooldown."""
+    now = time.monotonic()
+    last_sent = last_alert_times.get(alert_type)
+    if last_sent is not None and now - last_sent < alert_cooldown:
+        return
+    # Start the cooldown when the alert is queued so it is not queued again while in flight;
+    # create_and_send_email_alert clears it if the send fails
+    last_alert_times[alert_type] = now
+    email_executor.submit(create_and_send_email_alert, alert_type, email_message)
+
+def ack_message(ch, delivery_tag: int):
+    """Record a processed message and acknowledge it once a full batch has been received."""
+    global unacked_count, last_delivery_tag
+
+    unacked_count += 1
+    last_delivery_tag = delivery_tag
+    if unacked_count >= ack_batch_size:
+        flush_acks(ch)
+
+def flush_acks(ch):
+    """Acknowledge all processed messages up to the last delivery tag in a single frame."""
+    global unacked_count
+
+    if unacked_count > 0 and ch.is_open:
+        ch.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+        unacked_count = 0
+
+def schedule_ack_flush(connection, ch):
+    """Flush any partial ack batch and re-arm the timer so slow streams are not left unacknowledged."""
+    flush_acks(ch)
+    connection.ioloop.call_later(ack_flush_interval, lambda: schedule_ack_flush(connection, ch))
+
+def update_stall_window(heart_rate: float):
+    """Add a reading to the stall window, keeping its min and max available in O(1)."""
+    global stall_index
+
+    # Drop readings that can no longer be the window max or min
+    while stall_max_deque and stall_max_deque[-1][0] < heart_rate:
+        stall_max_deque.pop()
+    stall_max_deque.append((heart_rate, stall_index))
+    while stall_min_deque and stall_min_deque[-1][0] > heart_rate:
+        stall_min_deque.pop()
+    stall_min_deque.append((heart_rate, stall_index))
+
+    # Evict readings that have slid out of the window
+    oldest_index = stall_index - stall_window
+    while stall_max_deque[0][1] <= oldest_index:
+        stall_max_deque.popleft()
+    while stall_min_deque[0][1] <= oldest_index:
+        stall_min_deque.popleft()
+
+    stall_index += 1
 
 def monitor_callback(ch, method, properties, body):
     """Define behavior on getting a message about the heart rate."""
 
-    message = body.decode().split(",")
-    time_stamp = message[0]
-    heart_rate = float(message[1])
+    # Skip messages that are not in the 16-byte format (e.g. text messages from an older producer),
+    # acknowledging them so they are not redelivered on every restart
+    if len(body) != heart_rate_struct.size:
+        logger.warning("Skipping message with %s-byte body; expected %s bytes", len(body), heart_rate_struct.size)
+        ack_message(ch, method.delivery_tag)
+        return
 
-    # Add the heart rate to all deques
-    drop_deque.append(heart_rate)
-    stall_deque.append(heart_rate)
-    elevated_deque.append(heart_rate)
+    time_stamp, heart_rate = heart_rate_struct.unpack(body)
+
+    # Add the heart rate to the shared reading buffer and the stall window
+    reading_deque.append(heart_rate)
+    update_stall_window(heart_rate)
 
     # Check for heart rate drop
-    if len(drop_deque) == drop_deque.maxlen:
-        drop_change = drop_deque[-1] - drop_deque[0]
+    if len(reading_deque) >= drop_window:
+        drop_change = reading_deque[-1] - reading_deque[-drop_window]
         if drop_change <= -15:
-            print(f"HEART RATE DROP ALERT: Current heart rate is: {heart_rate}, change in last 2.5 minutes: {drop_change} bpm")
-            create_and_send_email_alert(drop_subject, drop_content)
+            logger.warning("HEART RATE DROP ALERT: Current heart rate is: %s, change in last 2.5 minutes: %s bpm", heart_rate, drop_change)
+            send_alert("drop", drop_message)
 
     # Check for heart rate stall
-    if len(stall_deque) == stall_deque.maxlen:
-        stall_change = max(stall_deque) - min(stall_deque)
+    if stall_index >= stall_window:
+        stall_change = stall_max_deque[0][0] - stall_min_deque[0][0]
         if stall_change < 1:
-            print(f"HEART RATE STALL ALERT: Current heart rate is: {heart_rate}, change in last 10 minutes: {stall_change} bpm")
-            create_and_send_email_alert(stall_subject, stall_content)
+            logger.warning("HEART RATE STALL ALERT: Current heart rate is: %s, change in last 10 minutes: %s bpm", heart_rate, stall_change)
+            send_alert("stall", stall_message)
 
     # Check for heart rate elevated
-    if len(elevated_deque) == elevated_deque.maxlen:
-        elevated_change = elevated_deque[-1] - elevated_deque[0]
+    if len(reading_deque) >= elevated_window:
+        elevated_change = reading_deque[-1] - reading_deque[-elevated_window]
         if elevated_change >= 20:
-            print(f"HEART RATE ELEVATED ALERT: Current heart rate is: {heart_rate}, change in last 2 minutes: {elevated_change} bpm")
-            create_and_send_email_alert(elevated_subject, elevated_content)
+            logger.warning("HEART RATE ELEVATED ALERT: Current heart rate is: %s, change in last 2 minutes: %s bpm", heart_rate, elevated_change)
+            send_alert("elevated", elevated_message)
+
+    logger.info("Current heart rate is: %s", heart_rate)
+
+    # Acknowledge the message was received and processed (in batches)
+    ack_message(ch, method.delivery_tag)
+
+def on_connection_open(connection):
+    """Open a communication channel once the connection to the RabbitMQ server is ready."""
+    connection.channel(on_open_callback=on_channel_open)
+
+def on_connection_open_error(connection, error):
+    """Report a failed connection to the RabbitMQ server and exit."""
+    print()
+    print("ERROR: connection to RabbitMQ server failed.")
+    print(f"Verify the server is running on host={connection.params.host}.")
+    print(f"The error says: {error}")
+    print()
+    sys.exit(1)
+
+def on_connection_closed(connection, reason):
+    """Stop the I/O loop once the connection to the RabbitMQ server is closed.
+
+    If the user did not ask to stop, the reason is kept so main() can report it and exit non-zero.
+    """
+    global close_reason
+
+    if not closing_connection and close_reason is None:
+        close_reason = reason
+    connection.ioloop.stop()
+
+def on_channel_closed(channel, reason):
+    """Report an unexpected channel close and close the connection, since nothing is left to consume."""
+    global close_reason
+
+    if closing_connection:
+        return
+    if close_reason is None:
+        close_reason = reason
+    if channel.connection.is_open:
+        channel.connection.close()
+
+def on_consumer_cancelled(frame):
+    """Report that the RabbitMQ server cancelled the consumer and close the connection."""
+    global close_reason
 
-    print(f"Current heart rate is: {heart_rate}")
+    if close_reason is None:
+        close_reason = f"the server cancelled the consumer on {heart_rate_monitor_queue}"
+    if consumer_channel.connection.is_open:
+        consumer_channel.connection.close()
 
-    # Acknowledge the message was received and processed
-    ch.basic_ack(delivery_tag=method.delivery_tag)
+def on_channel_open(channel):
+    """Start setting up the queue once the channel is open.
+
+    Each setup step is passed a callback, so pika waits for the server's reply
+    before the next step runs and a failed step closes the channel (see
+    on_channel_closed) instead of being skipped silently.
+    """
+    global consumer_channel
+
+    consumer_channel = channel
+    # Report channel errors (e.g. a failed declare) and consumer cancellations instead of sitting idle
+    channel.add_on_close_callback(on_channel_closed)
+    channel.add_on_cancel_callback(on_consumer_cancelled)
+    # Use the channel to declare a non-durable queue matching the producer (a no-op if it
+    # already exists, so readings the producer queued while this consumer was down are kept)
+    channel.queue_declare(heart_rate_monitor_queue, durable=False, callback=on_queue_declared)
+
+def on_queue_declared(frame):
+    """Declare the producer's fanout exchange once the queue exists."""
+    consumer_channel.exchange_declare(exchange=heart_rate_exchange, exchange_type="fanout", durable=True, callback=on_exchange_declared)
+
+def on_exchange_declared(frame):
+    """Bind the queue to the fanout exchange once the exchange exists."""
+    consumer_channel.queue_bind(queue=heart_rate_monitor_queue, exchange=heart_rate_exchange, callback=on_queue_bound)
+
+def on_queue_bound(frame):
+    """Set the prefetch count once the queue is bound."""
+    # Set the prefetch count to 64 so the broker keeps a window of messages in flight instead of waiting on each ack
+    consumer_channel.basic_qos(prefetch_count=64, callback=on_qos_set)
+
+def on_qos_set(frame):
+    """Start consuming once the prefetch count is set."""
+    # Configure the channel to listen on a specific queue and use the monitor_callback function
+    consumer_channel.basic_consume(heart_rate_monitor_queue, on_message_callback=monitor_callback, auto_ack=False, callback=on_consume_started)
+
+def on_consume_started(frame):
+    """Start the ack flush timer and tell the user the consumer is ready."""
+    # Periodically acknowledge partial batches so they are not held until the next full batch
+    connection = consumer_channel.connection
+    connection.ioloop.call_later(ack_flush_interval, lambda: schedule_ack_flush(connection, consumer_channel))
+    # Print a message to the console for the user
+    print(" [*] Ready for work. To exit press CTRL+C")
 
 def main(hn: str = "localhost", qn: str = "task_queue"):
     """ Continuously listen for task messages on a named queue.
@@ -151,39 +360,31 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
         host (str): the host name or IP address of the RabbitMQ server
         qn (str): queue name
     """
-    try:
-        # Try this code, if it works, keep going
-        # Create a blocking connection to the RabbitMQ server
-        connection = pika.BlockingConnection(pika.ConnectionParameters(host=hn))
-    except Exception as e:
-        print()
-        print("ERROR: connection to RabbitMQ server failed.")
-        print(f"Verify the server is running on host={hn}.")
-        print(f"The error says: {e}")
-        print()
-        sys.exit(1)
+    global closing_connection
+
+    # Create an asynchronous connection to the RabbitMQ server
+    # The channel and queues are set up from on_connection_open once the connection is ready
+    connection = pika.SelectConnection(
+        pika.ConnectionParameters(host=hn),
+        on_open_callback=on_connection_open,
+        on_open_error_callback=on_connection_open_error,
+        on_close_callback=on_connection_closed,
+    )
 
     try:
-        # Use the connection to create a communication channel
-        channel = connection.channel()
-        # Use the channel to clear the queue
-        channel.queue_delete(heart_rate_monitor_queue)
-        channel.queue_delete(heart_rate_drop_queue)
-        channel.queue_delete(heart_rate_stall_queue)
-        channel.queue_delete(heart_rate_elevated_queue)
-        # Use the channel to declare durable queues
-        channel.queue_declare(heart_rate_monitor_queue, durable=True)
-        channel.queue_declare(heart_rate_drop_queue, durable=True)
-        channel.queue_declare(heart_rate_stall_queue, durable=True)
-        channel.queue_declare(heart_rate_elevated_queue, durable=True)
-        # Set the prefetch count to one to limit the number of messages being consumed and processed concurrently
-        channel.basic_qos(prefetch_count=1)
-        # Configure the channel to listen on a specific queue and use the monitor_callback function
-        channel.basic_consume(heart_rate_monitor_queue, auto_ack=False, on_message_callback=monitor_callback)
-        # Print a message to the console for the user
-        print(" [*] Ready for work. To exit press CTRL+C")
-        # Start consuming messages via the communication channel
-        channel.start_consuming()
+        # Run the I/O loop, which delivers messages to the callback as they arrive
+        connection.ioloop.start()
+        # The loop only stops on its own when the connection closed without the user asking
+        if close_reason is not None:
+            print()
+            print("ERROR: something went wrong.")
+            print(f"The error says: {close_reason}")
+            # 406 PRECONDITION_FAILED on declare means the queue exists with other settings (e.g. durable)
+            if isinstance(close_reason, pika.exceptions.ChannelClosedByBroker) and close_reason.reply_code == 406:
+                print(f"The {heart_rate_monitor_queue} queue exists with different settings.")
+                print("Run hr-producer.py to recreate it, or delete it from the RabbitMQ admin site.")
+            print()
+            sys.exit(1)
     except Exception as e:
         print()
         print("ERROR: something went wrong.")
@@ -192,10 +393,23 @@ def main(hn: str = "localhost", qn: str = "task_queue"):
     except KeyboardInterrupt:
         print()
         print(" User interrupted continuous listening process.")
+        # Close the connection and let the I/O loop finish the closing handshake
+        closing_connection = True
+        if connection.is_open:
+            # Acknowledge the partial batch first. Acks are batched, so delivery is at-least-once:
+            # readings processed since the last ack (up to ack_batch_size - 1, or whatever is in flight
+            # if the process dies without this flush) are redelivered and reprocessed on restart.
+            if consumer_channel is not None:
+                flush_acks(consumer_channel)
+            connection.close()
+            connection.ioloop.start()
+        # Send any alerts still queued; each send is bounded by smtp_timeout
+        print(" Sending any pending email alerts before exiting.")
+        email_executor.shutdown(wait=True)
         sys.exit(0)
     finally:
         print("\nClosing connection. Goodbye.\n")
-        connection.close()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper(), format="%(message)s")
     main("localhost", "heart_rate_monitor_queue")
@@ -6,26 +6,36 @@ Name: Topaz Montague
 Date: 6.10.2024
 
 File Description & Approach:
-This Python script reads heart rate data from a CSV file and sends it to three RabbitMQ task queues, 
-simulating real-time heart rate readings from a wearable device. It establishes a RabbitMQ connection, 
-clears any existing messages in the queues, and declares durable queues for message persistence. 
-The script iterates through the CSV file, converts heart rate readings to floats, formats them as messages, 
-and publishes them to the respective queues with a 30-second delay between readings. 
+This Python script reads heart rate data from a CSV file and sends it to the RabbitMQ heart rate 
+monitor queue, simulating real-time heart rate readings from a wearable device. It establishes a 
+RabbitMQ connection, clears any existing messages in the queue, declares a non-durable queue (messages 
+are transient, since a stale heart rate reading adds no value to an alert), and binds it to a fanout 
+exchange. The script iterates through the CSV file, converts heart rate readings to floats, packs them 
+into 16-byte binary messages, and publishes each one once to the exchange, one reading every 30 seconds 
+by default. A single monitor consumer runs the drop, stall, and elevated checks on every reading. 
 Error handling ensures graceful exit if the RabbitMQ connection fails, and the connection is closed after processing.
 """
 
+import argparse
 import csv
+import logging
+import os
 import pika
+import struct
 import sys
 import time
 import webbrowser
 
+# Module logger
+logger = logging.getLogger(__name__)
+
 # Declare variables
 heart_rate_monitor_queue = "01-heart-rate-monitor"
-heart_rate_drop_queue = "02-heart-rate-drop"
-heart_rate_stall_queue = "03-heart-rate-stall"
-heart_rate_elevated_queue = "04-heart-rate-elevated"
+heart_rate_exchange = "hr-fanout"  # fanout exchange that copies each reading to every bound queue
 csv_file = 'heart_rate.csv'
+time_stamp_format = "%m/%d/%Y %H:%M"  # e.g. 1/1/2024 0:08
+heart_rate_struct = struct.Struct("<dd")  # 16-byte message: unix time stamp, heart rate (both float64)
+publish_batch_size = 100  # rows published per transaction commit in fast mode
 
 def offer_rabbitmq_admin_site(show_offer):
     """Offer to open the RabbitMQ Admin website."""
@@ -39,7 +49,38 @@ def offer_rabbitmq_admin_site(show_offer):
         webbrowser.open_new("http://localhost:15672/#/queues")
         print()
 
-def main(host: str, csv_file: str):
+def read_heart_rate_readings(csv_file: str) -> list:
+    """
+    Read the whole CSV file up front and return its valid readings.
+
+    Parameters:
+        csv_file (str): the CSV file to read data from
+
+    Returns:
+        list: (unix time stamp, heart rate) float tuples, skipping blank, short, or long rows
+              and rows whose values cannot be parsed
+    """
+    readings = []
+    with open(csv_file, 'r', newline='') as file:
+        reader = csv.reader(file, delimiter=',')
+        # Skip header
+        next(reader)
+
+        for row in reader:
+            # Skip blank lines and rows without exactly a time stamp and a heart rate
+            if len(row) != 2:
+                continue
+            time_stamp, heart_rate = row
+
+            # Convert time stamps and numbers to floats, dropping rows that cannot be converted
+            try:
+                time_stamp_value = time.mktime(time.strptime(time_stamp, time_stamp_format))
+                readings.append((time_stamp_value, float(heart_rate)))
+            except ValueError:
+                pass
+    return readings
+
+def main(host: str, csv_file: str, interval: float = 30.0):
     """
     Creates and sends a message to the queue each execution.
     This process runs and finishes.
@@ -47,63 +88,64 @@ def main(host: str, csv_file: str):
     Parameters:
         host (str): the host name or IP address of the RabbitMQ server
         csv_file (str): the CSV file to read data from
+        interval (float): seconds between readings; when 0, rows are
+            published back to back and committed in batches
     """
     try:
-        # Read CSV file
-        with open(csv_file, 'r') as file:
-            reader = csv.reader(file, delimiter=',')
-            # Skip header
-            header = next(reader)
-
-            try:
-                # Create a blocking connection to the RabbitMQ server
-                conn = pika.BlockingConnection(pika.ConnectionParameters(host))
-                # Use the connection to create a communication channel
-                ch = conn.channel()
-
-                # Clear queues to clear out old messages
-                ch.queue_delete(heart_rate_monitor_queue)
-                ch.queue_delete(heart_rate_drop_queue)
-                ch.queue_delete(heart_rate_stall_queue)
-                ch.queue_delete(heart_rate_elevated_queue)
-
-                # Declare durable queues
-                ch.queue_declare(heart_rate_monitor_queue, durable=True)
-                ch.queue_declare(heart_rate_drop_queue, durable=True)
-                ch.queue_declare(heart_rate_stall_queue, durable=True)
-                ch.queue_declare(heart_rate_elevated_queue, durable=True)
-
-                for row in reader:
-                    time_stamp, heart_rate = row
-
-                    # Convert numbers to floats and send messages to respective queues
-                    try:
-                        heart_rate_value = float(heart_rate)
-                        heart_rate_message = f"{time_stamp}, {heart_rate_value}".encode()
-                        ch.basic_publish(exchange="", routing_key=heart_rate_monitor_queue, body=heart_rate_message)
-                        print(f" [x] Sent {heart_rate_message} on {heart_rate_monitor_queue}")
-                        
-                        # Send the same message to specific queues for individual monitoring tasks
-                        ch.basic_publish(exchange="", routing_key=heart_rate_drop_queue, body=heart_rate_message)
-                        print(f" [x] Sent {heart_rate_message} on {heart_rate_drop_queue}")
-                        
-                        ch.basic_publish(exchange="", routing_key=heart_rate_stall_queue, body=heart_rate_message)
-                        print(f" [x] Sent {heart_rate_message} on {heart_rate_stall_queue}")
-                        
-                        ch.basic_publish(exchange="", routing_key=heart_rate_elevated_queue, body=heart_rate_message)
-                        print(f" [x] Sent {heart_rate_message} on {heart_rate_elevated_queue}")
-                    except ValueError:
-                        pass
-
-                    # Read values every 30 seconds
-                    time.sleep(30)
-
-            except pika.exceptions.AMQPConnectionError as e:
-                print(f"Error: Connection to RabbitMQ server failed: {e}")
-                sys.exit(30)
-            finally:
-                # Close the connection to the server
-                conn.close()
+        # Read and parse the CSV file before connecting, so the publish loop only publishes
+        readings = read_heart_rate_readings(csv_file)
+
+        try:
+            # Create a blocking connection to the RabbitMQ server
+            conn = pika.BlockingConnection(pika.ConnectionParameters(host))
+            # Use the connection to create a communication channel
+            ch = conn.channel()
+
+            # Clear the queue to clear out old messages
+            ch.queue_delete(heart_rate_monitor_queue)
+
+            # Declare a non-durable queue; readings stay in memory and are not persisted
+            ch.queue_declare(heart_rate_monitor_queue, durable=False)
+
+            # Declare the fanout exchange and bind the queue to it
+            ch.exchange_declare(exchange=heart_rate_exchange, exchange_type="fanout", durable=True)
+            ch.queue_bind(queue=heart_rate_monitor_queue, exchange=heart_rate_exchange)
+
+            # Publish in transactions so the broker confirms a whole batch with a single round trip
+            ch.tx_select()
+            uncommitted_rows = 0
+            # Schedule publishes on a fixed monotonic clock so publish time does not shift the schedule
+            next_publish_time = time.monotonic()
+
+            for time_stamp_value, heart_rate_value in readings:
+                # Pack the reading into a fixed-size binary message and send it to the exchange
+                heart_rate_message = heart_rate_struct.pack(time_stamp_value, heart_rate_value)
+                # Publish once; the fanout exchange delivers a copy to each bound queue
+                ch.basic_publish(exchange=heart_rate_exchange, routing_key="", body=heart_rate_message)
+                logger.info(" [x] Sent %s, %s on %s", time_stamp_value, heart_rate_value, heart_rate_exchange)
+                uncommitted_rows += 1
+
+                if interval > 0:
+                    # Commit so the reading is delivered now, then wait for the next scheduled reading
+                    ch.tx_commit()
+                    uncommitted_rows = 0
+                    next_publish_time += interval
+                    # conn.sleep keeps servicing the connection (e.g. heartbeats) while waiting
+                    conn.sleep(max(0, next_publish_time - time.monotonic()))
+                elif uncommitted_rows >= publish_batch_size:
+                    ch.tx_commit()
+                    uncommitted_rows = 0
+
+            # Commit any remaining rows from the last partial batch
+            if uncommitted_rows:
+                ch.tx_commit()
+
+        except pika.exceptions.AMQPConnectionError as e:
+            print(f"Error: Connection to RabbitMQ server failed: {e}")
+            sys.exit(30)
+        finally:
+            # Close the connection to the server
+            conn.close()
 
     except FileNotFoundError as e:
         print(f"Error: CSV file not found: {e}")
@@ -115,5 +157,11 @@ def main(host: str, csv_file: str):
 # Standard Python idiom to indicate main program entry point
 # This allows us to import this module and use its functions without executing the code below.
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream heart rate readings from a CSV file to RabbitMQ.")
+    parser.add_argument("--interval", type=float, default=30.0, metavar="SECONDS", help="seconds between readings (default: 30)")
+    parser.add_argument("--fast", "--no-delay", action="store_true", dest="fast", help="publish all readings as fast as the broker accepts them")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper(), format="%(message)s")
+
     offer_rabbitmq_admin_site("False")
-    main("localhost", csv_file)
+    main("localhost", csv_file, interval=0 if args.fast else args.interval)